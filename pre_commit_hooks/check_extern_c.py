@@ -11,6 +11,10 @@ import sys
 
 import git
 
+from pre_commit_hooks.util import check_files
+from pre_commit_hooks.util import iter_files
+from pre_commit_hooks.util import read_head_tail
+
 extern_c = {
     "condition": "#ifdef __cplusplus",
     "content_head": 'extern "C" {',
@@ -20,18 +24,13 @@ extern_c = {
 extern_c_regex = (
     "^({condition})[\n\r]{{0,2}}\\s*({content})[\n\r]{{0,2}}({end_condition})$"
 )
-extern_c_head = re.compile(
-    extern_c_regex.format(
-        condition=extern_c["condition"],
-        content=extern_c["content_head"],
-        end_condition=extern_c["end_condition"],
-    ),
-    re.MULTILINE,
-)
-extern_c_tail = re.compile(
+extern_c_head_or_tail = re.compile(
     extern_c_regex.format(
         condition=extern_c["condition"],
-        content=extern_c["content_tail"],
+        content="(?P<head>{})|(?P<tail>{})".format(
+            re.escape(extern_c["content_head"]),
+            re.escape(extern_c["content_tail"]),
+        ),
         end_condition=extern_c["end_condition"],
     ),
     re.MULTILINE,
@@ -43,6 +42,21 @@ extern_c_head_after = re.compile(
 extern_c_tail_before = re.compile(r"^#endif\s+//\s+[A-Z_\d]+_H_", re.MULTILINE)
 
 
+def has_extern_c(texts):
+    """Check whether both parts of the extern c are found in the texts."""
+    found_head = False
+    found_tail = False
+    for text in texts:
+        for match in extern_c_head_or_tail.finditer(text):
+            if match["head"]:
+                found_head = True
+            else:
+                found_tail = True
+            if found_head and found_tail:
+                return True
+    return False
+
+
 def check_file(project_path, header_file, fix):
     """Check whether the file contains a correct extern c.
         #ifdef __cplusplus
@@ -55,18 +69,20 @@ def check_file(project_path, header_file, fix):
     it is assumed that there is no trailing or leading whitespace.
     """
     # Only check .h files
-    if header_file[-2:] != ".h":
+    if not header_file.endswith(".h"):
         return True
-    found_head = False
-    found_tail = False
-    with open(header_file) as f:
-        content = f.read()
-    found_head = extern_c_head.search(content)
-    found_tail = extern_c_tail.search(content)
-    if found_head and found_tail:
+    head, tail = read_head_tail(header_file)
+    if has_extern_c((head, tail)):
         return True
+    content = head
+    if tail:
+        # The linkage-specification may be outside of the head and tail
+        with open(header_file) as f:
+            content = f.read()
+        if has_extern_c((content,)):
+            return True
     if fix:
-        insert_extern_c(project_path, header_file)
+        insert_extern_c(header_file, content)
         print(
             'Inserted extern "C" linkage-specification into %s' % (header_file),
         )
@@ -77,13 +93,11 @@ def check_file(project_path, header_file, fix):
     return False
 
 
-def insert_extern_c(project_path, header_file):
+def insert_extern_c(header_file, content):
     """Insert the extern "C" linkage-specification into the content"""
     # function declaration section
     head_insert = f'{extern_c["condition"]}\n{extern_c["content_head"]}\n{extern_c["end_condition"]}\n\n'
     tail_insert = f'{extern_c["condition"]}\n{extern_c["content_tail"]}\n{extern_c["end_condition"]}\n\n'
-    with open(header_file) as f:
-        content = f.read()
     extern_c_head_after_found = extern_c_head_after.search(content)
     if extern_c_head_after_found:
         content = (
@@ -114,19 +128,11 @@ def insert_extern_c(project_path, header_file):
 
 def check_dir(p, fix):
     """Walk recursively over a directory checking .h files"""
-
-    def prune(d):
-        """Check if dir is invisible/starts with '.'"""
-        if d[0] == ".":
-            return True
-        return False
-
-    all_good = True
-    for root, dirs, paths in os.walk(p):
-        # Prune dot directories like .git
-        [dirs.remove(d) for d in list(dirs) if prune(d)]
-        for path in paths:
-            all_good &= check_file(p, os.path.join(root, path), fix)
+    all_good = check_files(
+        lambda path: check_file(p, path, fix),
+        iter_files(p, ".h"),
+    )
+    return all_good
 
 
 def check_project(p, fix=False):
@@ -4,10 +4,14 @@
 from __future__ import annotations
 
 import argparse
+import functools
 import re
 import sys
 from pathlib import Path
 
+from pre_commit_hooks.util import check_files
+from pre_commit_hooks.util import iter_files
+
 settings = {
     "template": """
 /* --------------------------------------------------------------------------
@@ -36,53 +40,79 @@ settings = {
     },
     "deduplicate": True,
 }
+# Sections and section replacements of header and source files
+sections_by_suffix = {
+    ".h": (
+        tuple(settings.get("header", [])),
+        tuple(settings.get("replace", {}).get("header", [])),
+    ),
+    ".c": (
+        tuple(settings.get("source", [])),
+        tuple(settings.get("replace", {}).get("source", [])),
+    ),
+}
+section_marker = "/* -"
 section_regex = r"^{prefix}[\n\r]{{1,2}}\s\* {title}[\n\r]{{1,2}}{suffix}$"
-section_area_start = (
-    r"#ifndef\s[A-Z\d_]+_H_[\n\r]{{1,2}}#define\s[A-Z\d_]+_H_[\n\r]{{1,2}}",
+section_area_start = re.compile(
+    r"#ifndef\s[A-Z\d_]+_H_[\n\r]{1,2}#define\s[A-Z\d_]+_H_[\n\r]{1,2}",
 )
-section_area_end = r"#endif\s+//\s[A-Z\d_]+_H_"
+section_area_end = re.compile(r"#endif\s+//\s[A-Z\d_]+_H_")
+
+
+@functools.lru_cache(maxsize=64)
+def section_pattern(title, trailing_newlines=False):
+    """Compile the pattern matching the section with the given title."""
+    suffix = settings["suffix"]
+    if trailing_newlines:
+        suffix += r"[\n\r]*"
+    return re.compile(
+        section_regex.format(
+            prefix=settings["prefix"],
+            title=re.escape(title),
+            suffix=suffix,
+        ),
+        re.MULTILINE,
+    )
 
 
-def insert_section_at_end(content, title, end_index):
-    """Check if section is in content"""
-    stri = section_regex.format(
-        prefix=settings["prefix"],
-        title=title,
-        suffix=settings["suffix"],
-    )
-    regex = re.compile(stri, re.MULTILINE)
-    if m := regex.search(content):
-        return content, False, m.start()
-    return (
-        content[:end_index]
-        + settings["template"].format(title=title)
-        + "\n\n"
-        + content[end_index:],
-        True,
-        end_index,
-    )
+def insert_missing_sections(content, sections, end_index):
+    """Insert the sections missing in content. A missing section is inserted
+    right before the next section that is present, or at end_index.
+    """
+    inserts = []
+    for title in reversed(sections):
+        if title in content and (m := section_pattern(title).search(content)):
+            end_index = m.start()
+        else:
+            inserts.append((end_index, title))
+    if not inserts:
+        return content, False
+    # Build the new content in one go, sections sharing an offset are
+    # inserted in their original order
+    parts = []
+    previous = 0
+    for offset, title in sorted(reversed(inserts), key=lambda i: i[0]):
+        parts.append(content[previous:offset])
+        parts.append(settings["template"].format(title=title) + "\n\n")
+        previous = offset
+    parts.append(content[previous:])
+    return "".join(parts), True
 
 
 def replace_section(content, title, new_title):
     """Check if section is in content"""
-    stre = section_regex.format(
-        prefix=settings["prefix"],
-        title=title,
-        suffix=settings["suffix"],
-    )
-    regex = re.compile(stre, re.MULTILINE)
+    if title not in content:
+        return content, False
+    regex = section_pattern(title)
     t = regex.subn(settings["template"].format(title=new_title), content)
     return t[0], t[1] > 0
 
 
 def deduplicate_sections(content, title):
     """Check if section is in content"""
-    stre = section_regex.format(
-        prefix=settings["prefix"],
-        title=title,
-        suffix=(settings["suffix"] + r"[\n\r]*"),
-    )
-    regex = re.compile(stre, re.MULTILINE)
+    if content.count(title) < 2:
+        return content, False
+    regex = section_pattern(title, trailing_newlines=True)
     if m := regex.search(content):
         # Remove all following instances of the section
         clean, changes = regex.subn("", content[m.end() :])
@@ -94,32 +124,23 @@ def deduplicate_sections(content, title):
 
 
 def check_file(file: Path, fix):
-    sections = []
-    replace = []
     modified_file = False
     with open(file) as f:
         content = f.read()
-    if file.suffix == ".h":
-        sections = settings.get("header", [])
-        replace = settings.get("replace", {}).get("header", [])
-    elif file.suffix == ".c":
-        sections = settings.get("source", [])
-        replace = settings.get("replace", {}).get("source", [])
-    for r in replace:
-        content, changed = replace_section(content, r[0], r[1])
-        modified_file |= changed
+    sections, replace = sections_by_suffix.get(file.suffix, ((), ()))
+    # Without any section prefix there is nothing to replace or deduplicate
+    has_sections = section_marker in content
+    if has_sections:
+        for r in replace:
+            content, changed = replace_section(content, r[0], r[1])
+            modified_file |= changed
     end_index = len(content)
     if file.suffix == ".h":
-        reg = re.search(section_area_end, content)
+        reg = section_area_end.search(content)
         end_index = reg.start() if reg else end_index
-    for section in reversed(sections):
-        content, changed, end_index = insert_section_at_end(
-            content,
-            section,
-            end_index,
-        )
-        modified_file |= changed
-    if settings["deduplicate"]:
+    content, changed = insert_missing_sections(content, sections, end_index)
+    modified_file |= changed
+    if has_sections and settings["deduplicate"]:
         for section in sections:
             content, changed = deduplicate_sections(content, section)
             modified_file |= changed
@@ -136,18 +157,11 @@ def check_file(file: Path, fix):
 
 def check_dir(p, fix):
     """Walk recursively over a directory checking .h files"""
-
-    def prune(d):
-        if d[0] == ".":
-            return True
-        return False
-
-    all_good = True
-    for root, dirs, paths in p.walk():
-        # Prune dot directories like .git
-        [dirs.remove(d) for d in list(dirs) if prune(d)]
-        for path in paths:
-            all_good &= check_file(root / path, fix)
+    all_good = check_files(
+        lambda path: check_file(Path(path), fix),
+        iter_files(p, (".h", ".c")),
+    )
+    return all_good
 
 
 def check_project(p, fix=False):
@@ -6,27 +6,46 @@
 from __future__ import annotations
 
 import os
-import re
+import string
 import sys
 
 import git
 
-allowed_filenames = re.compile(
-    r"^([a-z\d\_\.]+|CMakeLists.txt|[A-Z\_]+.md|LICENSE)$",
+from pre_commit_hooks.util import check_files
+from pre_commit_hooks.util import iter_files
+
+lowercase_and_digits = frozenset(string.ascii_lowercase + string.digits)
+allowed_filename_chars = lowercase_and_digits | frozenset(
+    "_.",
 )  # only lowercase letters, digits,  underscore and dot
-allowed_folder_names = re.compile(
-    r"^[a-z\d\_\-]+$",
+allowed_folder_name_chars = lowercase_and_digits | frozenset(
+    "_-",
 )  # only lowercase letters, digits, underscore and hyphen
+allowed_markdown_chars = frozenset(string.ascii_uppercase + "_")
+special_filenames = frozenset(("CMakeLists.txt", "LICENSE"))
+
+
+def is_allowed_filename(name):
+    """Check a file name against the naming convention. Besides lower case
+    names, CMakeLists.txt, LICENSE and upper case markdown files like
+    README.md are allowed.
+    """
+    if name in special_filenames:
+        return True
+    if name.endswith(".md") and len(name) > 3:
+        if allowed_markdown_chars.issuperset(name[:-3]):
+            return True
+    return allowed_filename_chars.issuperset(name)
 
 
 def check_file(project_path, filename):
     # check against folder naming convention (e.g. "MyFolder" -> "my-folder", "my_folder" -> "my-folder")
-    path_elements = filename.relative_to(project_path).parts
-    for element in path_elements:
-        if not allowed_folder_names.match(element):
+    *folders, name = os.path.relpath(filename, project_path).split(os.sep)
+    for element in folders:
+        if not allowed_folder_name_chars.issuperset(element):
             print(f"Illegal folder name: {element} in {filename}")
             return False
-    if not allowed_filenames.match(filename.name):
+    if not is_allowed_filename(name):
         print(f"Illegal file name: {filename}")
         return False
     return True
@@ -34,18 +53,10 @@ def check_file(project_path, filename):
 
 def check_dir(project_dir):
     """Walk recursively over a directory checking all files"""
-
-    def prune(d):
-        if d[0] == ".":
-            return True
-        return False
-
-    all_good = True
-    for root, dirs, paths in os.walk(project_dir):
-        # Prune dot directories like .git
-        [dirs.remove(d) for d in list(dirs) if prune(d)]
-        for path in paths:
-            all_good &= check_file(project_dir, os.path.join(root, path))
+    all_good = check_files(
+        lambda path: check_file(project_dir, path),
+        iter_files(project_dir),
+    )
     return all_good
 
 
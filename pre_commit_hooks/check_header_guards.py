@@ -10,19 +10,32 @@ produces ABC_XYZ_XYZ_H_ as a header guard.
 from __future__ import annotations
 
 import argparse
-import collections
+import functools
+import mmap
 import os.path
-import pathlib
 import re
 import sys
+import threading
 
 import git
 
+from pre_commit_hooks.util import check_files
+from pre_commit_hooks.util import iter_files
 
-all_header_guards = collections.defaultdict(list)
-pragma_once = re.compile("^#pragma once$")
 
+all_header_guards = {}
+all_header_guards_lock = threading.Lock()
+guard_translation = str.maketrans("./\\-", "____")
+guard_directive = re.compile(
+    rb"^(?:(?P<pragma_once>#pragma once)"
+    rb"|#ifndef (?P<ifndef>.+?)"
+    rb"|#define (?P<define>.+?)"
+    rb"|#endif +// (?P<endif>.+?))\r?$",
+    re.MULTILINE,
+)
 
+
+@functools.lru_cache(maxsize=None)
 def get_header_guard(project_path, header_file):
     """A header guard can either be a #pragma once, or else a matching set of
         #ifndef PATH_TO_FILE_H_
@@ -37,78 +50,81 @@ def get_header_guard(project_path, header_file):
         """Convert a path to a header guard."""
         if type(path) in [list, tuple]:
             path = "_".join(path)
-        return (
-            path.upper()
-            .replace(".", "_")
-            .replace("/", "_")
-            .replace("\\", "_")
-            .replace("-", "_")
-            + "_"
-        )
+        return path.upper().translate(guard_translation) + "_"
 
     header_guard = dir_guard(
         [os.path.basename(project_path)]
-        + list(
-            pathlib.Path(os.path.relpath(header_file, project_path)).parts[1:],
-        ),
+        + os.path.relpath(header_file, project_path).split(os.sep)[1:],
     )
 
-    return header_guard
+    return sys.intern(header_guard)
+
+
+def count_guard_directives(data, header_guard):
+    """Count the #pragma once, #ifndef, #define and #endif directives of the
+    given header guard in data.
+    """
+    header_guard = header_guard.encode()
+    pragma_onces = ifndefs = defines = endifs = 0
+    for match in guard_directive.finditer(data):
+        kind = match.lastgroup
+        if kind == "pragma_once":
+            pragma_onces += 1
+        elif match[kind] != header_guard:
+            continue
+        elif kind == "ifndef":
+            ifndefs += 1
+        elif kind == "define":
+            defines += 1
+        else:
+            endifs += 1
+    return pragma_onces, ifndefs, defines, endifs
 
 
-def check_file(project_path, header_file):
+def check_file(project_path, header_file, content=None, header_guard=None):
     """Check whether the file has a correct header guard.
     In either the #pragma once case or the header guard case, it is
     assumed that there is no trailing or leading whitespace.
+    If the content is not passed in, the file is memory-mapped and searched
+    without reading it into a string.
     """
 
     # Only check .h files
-    if header_file[-2:] != ".h":
+    if not header_file.endswith(".h"):
         return True
-    header_guard = get_header_guard(project_path, header_file)
-    all_header_guards[header_guard].append(header_file)
-    ifndef = re.compile("^#ifndef %s$" % header_guard)
-    define = re.compile("^#define %s$" % header_guard)
-    endif = re.compile("^#endif +// %s$" % header_guard)
-    found_pragma_once = False
-    found_ifndef = False
-    found_define = False
-    found_endif = False
-    with open(header_file) as f:
-        for line in f.readlines():
-            match = pragma_once.match(line)
-            if match:
-                if found_pragma_once:
-                    print("%s contains multiple #pragma once" % header_file)
-                    return False
-                found_pragma_once = True
-            match = ifndef.match(line)
-            if match:
-                if found_ifndef:
-                    print(
-                        "%s contains multiple ifndef header guards"
-                        % header_file,
-                    )
-                    return False
-                found_ifndef = True
-            match = define.match(line)
-            if match:
-                if found_define:
-                    print(
-                        "%s contains multiple define header guards"
-                        % header_file,
-                    )
-                    return False
-                found_define = True
-            match = endif.match(line)
-            if match:
-                if found_endif:
-                    print(
-                        "%s contains multiple endif header guards"
-                        % header_file,
-                    )
-                    return False
-                found_endif = True
+    if header_guard is None:
+        header_guard = get_header_guard(project_path, header_file)
+    with all_header_guards_lock:
+        all_header_guards.setdefault(header_guard, []).append(header_file)
+    if content is not None:
+        counts = count_guard_directives(content.encode(), header_guard)
+    elif os.path.getsize(header_file) == 0:
+        # Empty files can not be memory-mapped
+        counts = (0, 0, 0, 0)
+    else:
+        with open(header_file, "rb") as f, mmap.mmap(
+            f.fileno(),
+            0,
+            access=mmap.ACCESS_READ,
+        ) as data:
+            counts = count_guard_directives(data, header_guard)
+    pragma_onces, ifndefs, defines, endifs = counts
+    if pragma_onces > 1:
+        print("%s contains multiple #pragma once" % header_file)
+        return False
+    if ifndefs > 1:
+        print("%s contains multiple ifndef header guards" % header_file)
+        return False
+    if defines > 1:
+        print("%s contains multiple define header guards" % header_file)
+        return False
+    if endifs > 1:
+        print("%s contains multiple endif header guards" % header_file)
+        return False
+    found_pragma_once = pragma_onces > 0
+    found_ifndef = ifndefs > 0
+    found_define = defines > 0
+    found_endif = endifs > 0
     if found_pragma_once:
         if found_ifndef or found_define or found_endif:
             print(
@@ -127,13 +143,12 @@ def check_file(project_path, header_file):
     return False
 
 
-def add_header_guard(project_path, header_file):
+def add_header_guard(project_path, header_file, content, header_guard=None):
     # Only check .h files
-    if header_file[-2:] != ".h":
+    if not header_file.endswith(".h"):
         return True
-    header_guard = get_header_guard(project_path, header_file)
-    with open(header_file) as f:
-        content = f.read()
+    if header_guard is None:
+        header_guard = get_header_guard(project_path, header_file)
     lines = content.split("\n")
     top = [
         f"#ifndef {header_guard}",
@@ -154,42 +169,44 @@ def add_header_guard(project_path, header_file):
         lines = top + lines
     with open(header_file, "w") as f:
         f.write("\n".join(lines))
-    all_header_guards[header_guard].append(header_file)
+    with all_header_guards_lock:
+        all_header_guards.setdefault(header_guard, []).append(header_file)
 
 
 def check_and_fix_file(project_path, header_file, fix):
-    result = check_file(project_path, header_file)
+    # Only check .h files
+    if not header_file.endswith(".h"):
+        return True
+    header_guard = get_header_guard(project_path, header_file)
+    content = None
+    if fix:
+        # Read once and share the content between the check and the fix
+        with open(header_file) as f:
+            content = f.read()
+    result = check_file(project_path, header_file, content, header_guard)
     if not result and fix:
-        add_header_guard(project_path, header_file)
+        add_header_guard(project_path, header_file, content, header_guard)
         print(f"Modified {header_file}")
     return result
 
 
 def check_dir(p, fix):
     """Walk recursively over a directory checking .h files"""
-
-    def prune(d):
-        """Check if dir is invisible/starts with '.'"""
-        if d[0] == ".":
-            return True
-        return False
-
-    all_good = True
-    for root, dirs, paths in os.walk(p):
-        # Prune dot directories like .git
-        [dirs.remove(d) for d in list(dirs) if prune(d)]
-        for path in paths:
-            all_good &= check_and_fix_file(p, os.path.join(root, path), fix)
+    all_good = check_files(
+        lambda path: check_and_fix_file(p, path, fix),
+        iter_files(p, ".h"),
+    )
     return all_good
 
 
 def check_collisions():
     all_good = True
-    for header_guard, paths in all_header_guards.items():
+    # The files were checked in parallel, sort them for a stable report
+    for header_guard, paths in sorted(all_header_guards.items()):
         if len(paths) == 1:
             continue
         print("Multiple files could use %s as a header guard:" % header_guard)
-        for path in paths:
+        for path in sorted(paths):
             print("    %s" % path)
         all_good = False
     return all_good
@@ -3,9 +3,16 @@
 from __future__ import annotations
 
 import argparse
+import concurrent.futures
+import functools
 import html
+import json
+import os
 import re
+import shutil
 import subprocess
+import sys
+import tempfile
 from datetime import datetime
 from enum import IntEnum
 from pathlib import Path
@@ -53,117 +60,507 @@ UNLICENSE_NOTICE = """ This file is part of {project_name}.
  For more information, please refer to <http://unlicense.org/>"""
 
 
+# "author|year" lines of every checked file, newest first
+author_index = {}
+author_cache_name = "check_legal.json"
+
+
 class State(IntEnum):
     Initial = (0,)
     Start = (1,)
     Found = (2,)
 
 
-def get_authors(filename, aliases, args):
-    lines = []
-    result = subprocess.run(
+def iter_fields(stream, size=65536):
+    """Yield the NUL separated fields of a binary stream while reading it.
+    Paths and names that are not UTF-8 are decoded with surrogateescape,
+    like the file names in sys.argv, so they can not stop the whole log.
+    """
+    rest = b""
+    while chunk := stream.read(size):
+        *fields, rest = (rest + chunk).split(b"\0")
+        for field in fields:
+            yield field.decode("utf-8", "surrogateescape")
+    if rest:
+        yield rest.decode("utf-8", "surrogateescape")
+
+
+def read_author_cache(git_dir, head):
+    """Read the "author|year" lines by path of a previous run, they are only
+    valid as long as HEAD did not move.
+    """
+    try:
+        with open(
+            os.path.join(git_dir, "hooks-cache", author_cache_name),
+            encoding="utf-8",
+        ) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict) or cache.get("head") != head:
+        return {}
+    return cache.get("paths", {})
+
+
+def write_author_cache(git_dir, head, paths):
+    """Replace the cache atomically. Parallel runs each write their own
+    temporary file, the last one to finish wins.
+    """
+    cache_dir = os.path.join(git_dir, "hooks-cache")
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = tempfile.NamedTemporaryFile(
+            "w",
+            encoding="utf-8",
+            dir=cache_dir,
+            delete=False,
+        )
+    except OSError:
+        return
+    try:
+        with tmp:
+            json.dump({"head": head, "paths": paths}, tmp)
+        os.replace(tmp.name, os.path.join(cache_dir, author_cache_name))
+    except OSError:
+        os.unlink(tmp.name)
+    except BaseException:
+        os.unlink(tmp.name)
+        raise
+
+
+def read_git_log(follow, revision="HEAD"):
+    """Append the "author|year" lines of the followed paths, a dict of paths
+    to the filenames they belong to, to the author index. git log starts at
+    revision. Renames are followed the same way --follow does: once a file
+    was renamed, older commits are looked up under its previous path.
+    Returns the followed paths added by each commit, they may be copies.
+    """
+    added = {}
+    with subprocess.Popen(
         [
             "git",
             "--no-pager",
             "log",
-            "--pretty=format:%an|%ad",
+            "--pretty=format:%x01%H %an|%ad",
             "--date=format:%Y",
-            "--follow",
-            "--",
-            filename,
+            "--name-status",
+            "-M",
+            "-z",
+            revision,
+        ],
+        stdout=subprocess.PIPE,
+    ) as process:
+        # Every commit starts with \x01, its header line is followed by NUL
+        # separated status and path fields, renames carry the old and new path
+        commit = line = None
+        fields = iter_fields(process.stdout)
+        for status in fields:
+            if status.startswith("\x01"):
+                line, _, status = status[1:].partition("\n")
+                commit, _, line = line.partition(" ")
+            if not status:
+                continue
+            path = next(fields)
+            if status[0] == "R":
+                old_path, path = path, next(fields)
+            if path not in follow:
+                continue
+            for filename in follow[path]:
+                author_index[filename].append(line)
+            if status[0] == "A":
+                added.setdefault(commit, {})[path] = follow[path]
+            elif status[0] == "R":
+                follow.setdefault(old_path, []).extend(follow.pop(path))
+    return added
+
+
+def find_copies(added):
+    """Find the files the paths added by the given commits were copied
+    from. --follow looks for copies among all files of the parent commit,
+    which is far too slow for the whole history, so only these commits are
+    searched.
+    Returns the copied paths to follow by commit.
+    """
+    result = subprocess.run(
+        [
+            "git",
+            "diff-tree",
+            "--stdin",
+            "--root",
+            "-r",
+            "-z",
+            "--name-status",
+            "--find-copies-harder",
+        ],
+        input="".join(commit + "\n" for commit in added).encode("utf-8"),
+        stdout=subprocess.PIPE,
+    )
+    # Every commit id is followed by the NUL separated fields of its changes
+    copies = {}
+    commit = None
+    fields = iter(result.stdout.decode("utf-8", "surrogateescape").split("\0"))
+    for status in fields:
+        if status in added:
+            commit = status
+            continue
+        if not status:
+            continue
+        path = next(fields)
+        if status[0] in "RC":
+            old_path, path = path, next(fields)
+        if status[0] == "C" and path in added[commit]:
+            copies.setdefault(commit, {}).setdefault(old_path, []).extend(
+                added[commit][path],
+            )
+    return copies
+
+
+def build_author_index(filenames):
+    """Collect the "author|year" lines of all files from a single git log
+    over the whole history, instead of running git log --follow once per
+    file. Like --follow, files are followed across renames and copies.
+    The lines are cached in the git directory for the current HEAD, git log
+    only runs for files that are not in the cache.
+    """
+    result = subprocess.run(
+        [
+            "git",
+            "rev-parse",
+            "--show-toplevel",
+            "--absolute-git-dir",
+            "--verify",
+            "-q",
+            "HEAD",
         ],
         stdout=subprocess.PIPE,
     )
-    result = result.stdout.decode("utf-8")
-    if result:
-        lines = result.split("\n")
+    # Outside of a repository or without commits some of them are missing
+    lines = result.stdout.decode("utf-8", "surrogateescape").splitlines()
+    toplevel, git_dir, head = (lines + ["", "", ""])[:3]
+    cache = read_author_cache(git_dir, head) if head else {}
+    paths = {}
+    follow = {}
+    author_index.clear()
+    for filename in filenames:
+        path = os.path.normpath(filename)
+        if toplevel:
+            path = os.path.relpath(os.path.abspath(filename), toplevel)
+        path = Path(path).as_posix()
+        if path in cache:
+            author_index[filename] = cache[path]
+            continue
+        paths[filename] = path
+        follow.setdefault(path, []).append(filename)
+        author_index[filename] = []
+    fallback_author.cache_clear()
+    get_authors.cache_clear()
+    if not follow or not head:
+        return
+    # Copies are followed from the parent of the commit that made them
+    pending = [(follow, "HEAD")]
+    while pending:
+        follow, revision = pending.pop()
+        added = read_git_log(follow, revision)
+        if added:
+            for commit, sources in find_copies(added).items():
+                pending.append((sources, commit + "^"))
+    for filename, path in paths.items():
+        cache[path] = author_index[filename]
+    write_author_cache(git_dir, head, cache)
+
+
+@functools.lru_cache(maxsize=1)
+def fallback_author():
+    """Get the "author|year" line of files without history: the configured
+    git user in the current year. It is the same for the whole run.
+    """
+    username = subprocess.run(
+        ["git", "config", "user.name"],
+        stdout=subprocess.PIPE,
+    )
+    username = username.stdout.decode("utf-8").strip()
+    return "|".join([username, datetime.now().strftime("%Y")])
+
+
+@functools.lru_cache(maxsize=None)
+def get_authors(filename, aliases, copyright_string):
+    """Collect the authors of a file and the years they worked on it from
+    the author index. aliases is a frozenset of (name, alias) pairs.
+    """
+    aliases = dict(aliases)
+    lines = author_index.get(filename, [])
     if not lines:
-        username = subprocess.run(
-            ["git", "config", "user.name"],
-            stdout=subprocess.PIPE,
-        )
-        username = username.stdout.decode("utf-8").strip()
-        lines = ["|".join([username, datetime.now().strftime("%Y")])]
+        lines = [fallback_author()]
     authors = {}
     for line in lines:
         pair = line.split("|")
-        author = aliases.get(pair[0], pair[0])
-        date = pair[1]
-        dates = authors.get(author, [])
-        dates.append(date)
-        authors[author] = sorted(set(dates))
+        author = sys.intern(aliases.get(pair[0], pair[0]))
+        authors.setdefault(author, set()).add(pair[1])
     lines = []
     for author, dates in authors.items():
         lines.append(
-            args.copyright_string + " " + ", ".join(dates) + " " + author,
+            copyright_string + " " + ", ".join(sorted(dates)) + " " + author,
         )
     return "\n".join(sorted(lines))
 
 
-def full_notice(filename, aliases, args):
+def format_notice(authors, args):
     result = []
-    if args.preamble:
-        result += args.preamble.format(
-            project_name=args.programme_name,
-            authors=get_authors(filename, aliases, args),
-            license_notice=args.license_notice,
-        ).splitlines()
-    result += args.template.format(
-        project_name=args.programme_name,
-        authors=get_authors(filename, aliases, args),
-        license_notice=args.license_notice,
-    ).splitlines()
-    if args.postamble:
-        result += args.postamble.format(
+    for template in (args.preamble, args.template, args.postamble):
+        if not template:
+            continue
+        text = template.format(
             project_name=args.programme_name,
-            authors=get_authors(filename, aliases, args),
+            authors=authors,
             license_notice=args.license_notice,
-        ).splitlines()
-    string = args.line_start + f"\n{args.line_start}".join(result)
-    return f"{args.comment_start}\n{string}\n{args.comment_end}"
+        )
+        result.append(text[:-1] if text.endswith("\n") else text)
+    # Prefix every line with the line start in a single pass
+    notice = args.line_start + "\n".join(result).replace(
+        "\n",
+        "\n" + args.line_start,
+    )
+    # Comment styles without block delimiters have no start and end line
+    if args.comment_start:
+        notice = args.comment_start + "\n" + notice
+    if args.comment_end:
+        notice += "\n" + args.comment_end
+    return notice
 
 
-def add_comment(content, filename, aliases, full_notice):
-    position = 0
-    length = len(content)
+def split_notice(args):
+    """Format the notice once with a placeholder for the authors, they are
+    the only part that differs between files. Returns the literal chunks
+    around the authors, a single chunk if the notice has no authors.
+    """
+    return format_notice("\0", args).split("\0")
+
+
+def full_notice(filename, aliases, args):
+    if len(args.notice_chunks) == 1:
+        # The notice has no authors and is the same for all files
+        return args.notice_chunks[0]
+    authors = get_authors(
+        filename,
+        frozenset(aliases.items()),
+        args.copyright_string,
+    )
+    # Every line of the authors starts a line of the comment
+    authors = authors.replace("\n", "\n" + args.line_start)
+    return authors.join(args.notice_chunks)
+
+
+def header_end(data, top_lines, comment_delimiters=None):
+    """Get the end of the first top_lines lines of the encoded content data,
+    which are searched for an existing notice. If a block comment is still
+    open there, the header reaches to its end. 0 lines means all of data.
+    """
+    if top_lines <= 0:
+        return len(data)
+    end = -1
+    for _ in range(top_lines):
+        end = data.find(b"\n", end + 1)
+        if end == -1:
+            return len(data)
+    end += 1
+    if comment_delimiters:
+        comment_start, comment_end = (
+            delimiter.encode("utf-8") for delimiter in comment_delimiters
+        )
+        # Only extend if the last delimiter in the header opens a comment
+        if data.rfind(comment_start, 0, end) > data.rfind(comment_end, 0, end):
+            close = data.find(comment_end, end)
+            end = close + len(comment_end) if close != -1 else len(data)
+    return end
+
+
+@functools.lru_cache(maxsize=16)
+def comment_scanner(full_notice, comment_start, comment_end):
+    """Compile a pattern finding the notice, comment starts and comment ends
+    in a single pass over the encoded content. The lookahead reports
+    overlapping tokens like the "/*" in "*/*", and the notice wins over the
+    comment start it begins with.
+    """
+    return re.compile(
+        rb"(?=(?P<notice>%s)|(?P<start>%s)|(?P<end>%s))"
+        % (
+            re.escape(full_notice.encode("utf-8")),
+            re.escape(comment_start.encode("utf-8")),
+            re.escape(comment_end.encode("utf-8")),
+        ),
+    )
+
+
+def add_comment(
+    content,
+    filename,
+    aliases,
+    full_notice,
+    comment_start="/*",
+    comment_end="*/",
+    top_lines=0,
+):
+    # Work on the UTF-8 bytes, offsets are byte offsets
+    data = content.encode("utf-8")
+    scanner = comment_scanner(full_notice, comment_start, comment_end)
+    cutoff = header_end(data, top_lines, (comment_start, comment_end))
+    comment_end = comment_end.encode("utf-8")
     state = State.Initial
     start = 0
     end = 0
-    while position != length:
-        if state == State.Initial:
-            idx = content.find("/*", position)
-            if idx != -1:
-                state = State.Start
-                position = idx
-                start = idx
-            else:
-                position = length
-        elif state == State.Start:
-            idx1 = content.find(full_notice, position)
-            idx2 = content.find("*/", position)
-            if idx1 != -1 and idx2 != -1 and idx1 < idx2:
-                state = State.Found
-                end = idx2 + 2
-                position = length
-            elif idx1 != -1 and idx2 != -1:
-                state = State.Initial
-                position = min(idx1, idx2)
-            elif idx1 != -1 and idx2 == -1:
-                state = State.Initial
-                position = idx1
-            elif idx1 == -1 and idx2 != -1:
-                state = State.Initial
-                position = idx2
-            else:
-                state = State.Initial
-                position = length
+    for match in scanner.finditer(data, 0, cutoff):
+        kind = match.lastgroup
+        if kind == "notice":
+            if state == State.Initial:
+                start = match.start()
+            state = State.Found
+            # Replace up to the end of the comment the notice is part of
+            end = data.find(comment_end, match.start())
+            end = end + len(comment_end) if end != -1 else match.end(kind)
+            break
+        elif kind == "start" and state == State.Initial:
+            state = State.Start
+            start = match.start()
+        elif kind == "end":
+            state = State.Initial
     if state == State.Found:
-        content = content[:start] + full_notice + content[end:]
+        data = data[:start] + full_notice.encode("utf-8") + data[end:]
+        content = data.decode("utf-8")
     else:
         content = full_notice + "\n\n" + content
     return content
 
 
+def add_line_comment(content, full_notice, line_start):
+    """add_comment for comment styles without block delimiters, like # in
+    Python. The notice is only looked for in the comment lines at the top
+    of the file. A missing notice is inserted after a leading shebang line,
+    which has to stay the first line of executable scripts.
+    """
+    prefix = line_start.strip()
+    position = 0
+    end = 0
+    while prefix and content.startswith(prefix, position):
+        end = content.find("\n", position)
+        if end == -1:
+            end = len(content)
+            break
+        position = end + 1
+    start = content.find(full_notice, 0, end)
+    if start != -1:
+        end = start + len(full_notice)
+        return content[:start] + full_notice + content[end:]
+    shebang = ""
+    if content.startswith("#!"):
+        shebang, _, content = content.partition("\n")
+        shebang += "\n"
+    return shebang + full_notice + "\n\n" + content
+
+
+def contains_text(data, text):
+    """Check case-insensitively whether the encoded file content data
+    contains text. ASCII content is searched without decoding it.
+    """
+    if data.isascii() and text.isascii():
+        return text.lower().encode("ascii") in data.lower()
+    return text.casefold() in data.decode("utf-8").casefold()
+
+
+def process_file(filename, aliases, args, copyright_regex):
+    """Check a single file for the copyright/license notice.
+    Returns the filename and the new content, which is None if the file
+    already has the notice.
+    """
+    data = None
+    file = Path(args._dir) / filename
+    with open(file, "rb") as f:
+        data = f.read()
+    if b"\r" in data:
+        # Translate newlines like reading in text mode does
+        data = data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+    # Only the header is searched for an existing notice
+    header = data
+    if args.top_lines > 0:
+        end = header_end(data, args.top_lines, args.comment_delimiters)
+        header = data[:end]
+    # Check for the copyright string before building the notice
+    if copyright_regex:
+        if copyright_regex.search(header.decode("utf-8")):
+            return filename, None
+    notice = full_notice(filename, aliases, args)
+    if not copyright_regex:
+        # Without a copyright string each file must contain its own notice.
+        # Files lacking the part in front of the authors can not contain it,
+        # a notice without authors is the signature itself.
+        has_signature = len(args.notice_chunks) == 1 or contains_text(
+            header,
+            args.notice_chunks[0],
+        )
+        if has_signature and contains_text(header, notice):
+            return filename, None
+    # The content is only decoded as text when the notice is added
+    content = data.decode("utf-8")
+    if args.comment_delimiters:
+        new_content = add_comment(
+            content,
+            filename,
+            aliases,
+            notice,
+            *args.comment_delimiters,
+            args.top_lines,
+        )
+    else:
+        new_content = add_line_comment(content, notice, args.line_start)
+    if new_content == content:
+        return filename, None
+    return filename, new_content
+
+
+def write_file(path, content):
+    """Replace the file atomically, an interrupted write can not leave it
+    truncated. Symlinks are written through and the file keeps its
+    permissions.
+    """
+    path = os.path.realpath(path)
+    tmp = tempfile.NamedTemporaryFile(
+        "w",
+        encoding="utf-8",
+        dir=os.path.dirname(path),
+        delete=False,
+    )
+    try:
+        with tmp:
+            tmp.write(content)
+        shutil.copymode(path, tmp.name)
+        os.replace(tmp.name, path)
+    except BaseException:
+        os.unlink(tmp.name)
+        raise
+
+
+def prepare_args(args):
+    """Select and unescape the templates and parse the aliases once.
+    Returns the aliases as a dict.
+    """
+    if args.license_notice == "gpl3+":
+        args.template = GPL3_LICENSE_NOTICE
+    elif args.license_notice == "unlicense":
+        args.template = UNLICENSE_NOTICE
+    args.template = html.unescape(args.template)
+    args.copyright_string = html.unescape(args.copyright_string)
+    aliases = dict(alias.split(":", 1) for alias in args.alias)
+    args.notice_chunks = split_notice(args)
+    # Block comments are scanned for their delimiters, comment styles with
+    # only a line start are not
+    args.comment_delimiters = None
+    if args.comment_start.strip() and args.comment_end.strip():
+        args.comment_delimiters = (
+            args.comment_start.strip(),
+            args.comment_end.strip(),
+        )
+    return aliases
+
+
 def main(argv=None):
     parser = argparse.ArgumentParser(
         description="Prepend/update copyright and license notices",
@@ -229,42 +626,48 @@ def main(argv=None):
         help="Start of each line new line in the comment block.",
         default=" *",
     )
+    parser.add_argument(
+        "--detect-license-in-X-top-lines",
+        type=int,
+        help="Only look for an existing notice in the first X lines, 0 for all lines.",
+        dest="top_lines",
+        default=0,
+    )
     args = parser.parse_args(argv)
-    if args.license_notice == "gpl3+":
-        args.template = GPL3_LICENSE_NOTICE
-    elif args.license_notice == "unlicense":
-        args.template = UNLICENSE_NOTICE
-    elif not args.template:
+    if args.license_notice == "custom" and not args.template:
         print("No license template provided")
         return 1
-    args.template = html.unescape(args.template)
-    args.copyright_string = html.unescape(args.copyright_string)
-    aliases = {}
-    for alias in args.alias:
-        pair = alias.split(":")
-        aliases[pair[0]] = pair[1]
+    aliases = prepare_args(args)
+    # A given copyright string is a pattern, otherwise the notice is searched
+    copyright_regex = None
+    if args.copyright_string:
+        copyright_regex = re.compile(args.copyright_string, re.IGNORECASE)
+    # Only notices with authors need the history of the files
+    if len(args.notice_chunks) > 1:
+        build_author_index(args.filenames)
+    # Check the files in parallel, but report and write them in order
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        results = list(
+            executor.map(
+                lambda filename: process_file(
+                    filename,
+                    aliases,
+                    args,
+                    copyright_regex,
+                ),
+                args.filenames,
+            ),
+        )
     ret = 0
-    _dir = Path(args._dir)
-    for filename in args.filenames:
-        notice = full_notice(filename, aliases, args)
-        if not args.copyright_string:
-            args.copyright_string = notice
-        content = None
-        file = _dir / filename
-        with open(file.resolve(), encoding="utf-8") as f:
-            content = f.read()
-        if re.search(args.copyright_string, content, re.IGNORECASE):
+    for filename, content in results:
+        if content is None:
             continue
-        new_content = add_comment(content, filename, aliases, notice)
-        if new_content != content:
-            content = new_content
-            ret = 1
-            if args.dry_run:
-                print(f"{filename}: missing copyright/license notice")
-            else:
-                print(f"{filename}: update copyright/license notice")
-                with open(filename, "w", encoding="utf-8") as f:
-                    f.write(content)
+        ret = 1
+        if args.dry_run:
+            print(f"{filename}: missing copyright/license notice")
+        else:
+            print(f"{filename}: update copyright/license notice")
+            write_file(Path(args._dir) / filename, content)
     return ret
 
 
@@ -284,9 +687,10 @@ if __name__ == "__main__":
                 "Jane:Smith",
                 "-c",
                 "license",
+                "--dry-run",
             ],
         )
-        != 1
+        != 0
     ):
         exit(1)
     if (
@@ -342,3 +746,31 @@ if __name__ == "__main__":
         != 1
     ):
         exit(1)
+    if (
+        main(
+            [
+                "tests/c.h",
+                "-c",
+                "License",
+                "--detect-license-in-X-top-lines",
+                "2",
+                "--dry-run",
+            ],
+        )
+        != 0
+    ):
+        exit(1)
+    if (
+        main(
+            [
+                "tests/c.h",
+                "-c",
+                "TEST_FILE_H_",
+                "--detect-license-in-X-top-lines",
+                "2",
+                "--dry-run",
+            ],
+        )
+        != 1
+    ):
+        exit(1)
@@ -0,0 +1,105 @@
+"""Helpers shared by the pre-commit hooks."""
+
+from __future__ import annotations
+
+import collections
+import concurrent.futures
+import io
+import os
+import sys
+import threading
+
+
+def iter_files(root, suffixes=None):
+    """Walk recursively over a directory yielding the paths of all files.
+    Dot directories like .git are pruned and symlinked directories are not
+    followed, matching os.walk's defaults. If suffixes is given (a string or
+    a tuple of strings), only files whose name ends with one of them are
+    yielded.
+    """
+    pending = collections.deque([root])
+    while pending:
+        try:
+            it = os.scandir(pending.popleft())
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name[0] != ".":
+                        pending.append(entry.path)
+                elif suffixes and not entry.name.endswith(suffixes):
+                    continue
+                elif not entry.is_dir():
+                    yield entry.path
+
+
+class ThreadOutput:
+    """Stand-in for sys.stdout that collects what each worker thread prints
+    in a buffer of its own. Other threads write to the wrapped stream.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text):
+        buffer = getattr(self.local, "buffer", None)
+        if buffer is None:
+            return self.stream.write(text)
+        return buffer.write(text)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def check_files(check, paths):
+    """Run check on all paths in a thread pool. Reading the files releases
+    the GIL, so the checks of different files overlap. What the checks
+    print is buffered and printed in the order of paths once all are done.
+    Returns whether all checks passed.
+    """
+    output = ThreadOutput(sys.stdout)
+
+    def buffered_check(path):
+        output.local.buffer = io.StringIO()
+        try:
+            return check(path), output.local.buffer.getvalue()
+        finally:
+            output.local.buffer = None
+
+    sys.stdout = output
+    try:
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            results = list(executor.map(buffered_check, paths))
+    finally:
+        sys.stdout = output.stream
+    for _, text in results:
+        sys.stdout.write(text)
+    return all(result for result, _ in results)
+
+
+def decode_text(f):
+    """Read the binary file f as text with the defaults of open(path)."""
+    with io.TextIOWrapper(f) as text:
+        return text.read()
+
+
+def read_head_tail(path, head=8192, tail=2048):
+    """Read only the beginning and the end of a file.
+    Returns a (head, tail) tuple of strings cut at line boundaries. Files
+    of at most head + tail bytes are read as a whole and returned as head
+    with an empty tail. Both are decoded like open(path) does in text mode.
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size <= head + tail:
+            return decode_text(f), ""
+        first = f.read(head)
+        f.seek(-tail, os.SEEK_END)
+        last = f.read()
+    # Drop the partial lines at the inner edges of both windows, lines end
+    # with \n, \r\n or \r
+    first = first[: max(first.rfind(b"\n"), first.rfind(b"\r")) + 1]
+    ends = [i for i in (last.find(b"\n"), last.find(b"\r")) if i != -1]
+    last = last[min(ends, default=-1) + 1 :]
+    return decode_text(io.BytesIO(first)), decode_text(io.BytesIO(last))